@@ -32,8 +32,13 @@ import sys
 if sys.version_info[0] != 3:
   raise EnvironmentError('Creator {0} requires Python 3'.format(__version__))
 
-import creator.macro
-import creator.ninja
-import creator.platform
-import creator.unit
-import creator.utils
+_submodules = frozenset(['macro', 'ninja', 'platform', 'unit', 'utils'])
+
+
+def __getattr__(name):
+  # Submodules are imported on first access to keep the start-up of
+  # the command-line interface cheap.
+  if name in _submodules:
+    import importlib
+    return importlib.import_module('creator.' + name)
+  raise AttributeError("module 'creator' has no attribute '{0}'".format(name))
@@ -18,86 +18,228 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-import creator.unit
-import creator.utils
-import creator.ninja
-
 import argparse
+import enum
+import functools
 import os
-import glob
-import subprocess
 import sys
-import traceback
-
-from creator.utils import term_print
-
-
-parser = argparse.ArgumentParser(prog='creator',
-  description='Creator - Meta build system for ninja.')
-parser.add_argument('-D', '--define', help='Define a global variable that '
-  'is accessible to all unit scripts. If no value is specified, it will be '
-  'set to an empty string.', default=[], action='append')
-parser.add_argument('-M', '--macro', help='The same as -D/--define but '
-  ' evaluates like a macro. Remember that backslashes must be escaped, etc.',
-  default=[], action='append')
-parser.add_argument('-i', '--unitpath', help='Add an additional path to '
-  'search for unit scripts to the workspace. The environment variable '
-  'CREATORPATH is taken into account automatically as the search path '
-  'additionally to the built-in script path and the current directory.',
-  default=[], action='append')
-parser.add_argument('-u', '--unit', help='The identifier of the unit to '
-  'take as the main build unit. If this argument is omitted, it will be '
-  'determined from the files in the current directory. There must only be '
-  'one unit in the current directory if the automatic detection is used.')
-parser.add_argument('targets', metavar='target', nargs='*', help='One or '
-  'more full or local target or task identifiers to execute. Ninja will be '
-  'invoked separately for each specified target.')
-parser.add_argument('-e', '--export', help='Export the build.ninja file '
-  'only. The specified targets will be the default targets in the file. '
-  'A warning will be printed if any non-targets (ie. tasks) are specified.',
-  action='store_true')
-parser.add_argument('-n', '--no-export', help='Force not to export new '
-  'build definitions. Conflicts with -e/--export.', action='store_true')
-parser.add_argument('-d', '--dry', help='Dry run the unit scripts, but '
-  'do nothing more. Implies -n/--no-export.', action='store_true')
-parser.add_argument('-o', '--output', help='Override the output file of '
-  'the ninja build definitions. By default, the file will be created at '
-  '<build.ninja>. If the <$NinjaOut> variable is specified in a unit, it '
-  'will be used as the output file if this option is omitted.')
-parser.add_argument('-c', '--clean', help='Clean the output files of the '
-  'specified targets or all output files if no targets are specified. '
-  'Implies -n/--no-export.', action='store_true')
-parser.add_argument('--clean-with-dependencies', help='Like -c/--clean, '
-  'but also cleans all the dependencies of the specified targets. '
-  'Implies -c/--clean.', action='store_true')
-parser.add_argument('-v', '--verbose', help='Adds the `-v` option to '
-  'the inja invokation.', action='store_true')
-parser.add_argument('-a', '--args', help='Additional arguments for all '
-  'invokations of <ninja> done by Creator.', nargs=argparse.REMAINDER,
-  default=[])
+
+
+class _AppendAction(argparse.Action):
+  """
+  Like the ``'append'`` action, but appends to the list in place
+  instead of copying it for every occurence of the option.
+  """
+
+  def __call__(self, parser, namespace, values, option_string=None):
+    items = getattr(namespace, self.dest, None)
+    if items is None or items is self.default:
+      items = list(items or ())
+      setattr(namespace, self.dest, items)
+    items.append(values)
+
+
+@functools.lru_cache(maxsize=1)
+def get_parser():
+  """
+  Returns:
+    argparse.ArgumentParser: The parser for the command-line interface.
+      It is only constructed on the first call.
+  """
+
+  parser = argparse.ArgumentParser(prog='creator',
+    description='Creator - Meta build system for ninja.')
+  parser.add_argument('-D', '--define', help='Define a global variable that '
+    'is accessible to all unit scripts. If no value is specified, it will be '
+    'set to an empty string.', default=[], action=_AppendAction)
+  parser.add_argument('-M', '--macro', help='The same as -D/--define but '
+    ' evaluates like a macro. Remember that backslashes must be escaped, etc.',
+    default=[], action=_AppendAction)
+  parser.add_argument('-i', '--unitpath', help='Add an additional path to '
+    'search for unit scripts to the workspace. The environment variable '
+    'CREATORPATH is taken into account automatically as the search path '
+    'additionally to the built-in script path and the current directory.',
+    default=[], action=_AppendAction)
+  parser.add_argument('-u', '--unit', help='The identifier of the unit to '
+    'take as the main build unit. If this argument is omitted, it will be '
+    'determined from the files in the current directory. There must only be '
+    'one unit in the current directory if the automatic detection is used.')
+  parser.add_argument('targets', metavar='target', nargs='*', help='One or '
+    'more full or local target or task identifiers to execute. Ninja will be '
+    'invoked separately for each specified target.')
+  parser.add_argument('-e', '--export', help='Export the build.ninja file '
+    'only. The specified targets will be the default targets in the file. '
+    'A warning will be printed if any non-targets (ie. tasks) are specified.',
+    action='store_true')
+  parser.add_argument('-n', '--no-export', help='Force not to export new '
+    'build definitions. Conflicts with -e/--export.', action='store_true')
+  parser.add_argument('-d', '--dry', help='Dry run the unit scripts, but '
+    'do nothing more. Implies -n/--no-export.', action='store_true')
+  parser.add_argument('-o', '--output', help='Override the output file of '
+    'the ninja build definitions. By default, the file will be created at '
+    '<build.ninja>. If the <$NinjaOut> variable is specified in a unit, it '
+    'will be used as the output file if this option is omitted.')
+  parser.add_argument('-c', '--clean', help='Clean the output files of the '
+    'specified targets or all output files if no targets are specified. '
+    'Implies -n/--no-export.', action='store_true')
+  parser.add_argument('--clean-with-dependencies', help='Like -c/--clean, '
+    'but also cleans all the dependencies of the specified targets. '
+    'Implies -c/--clean.', action='store_true')
+  parser.add_argument('-v', '--verbose', help='Adds the `-v` option to '
+    'the inja invokation.', action='store_true')
+  parser.add_argument('-a', '--args', help='Additional arguments for all '
+    'invokations of <ninja> done by Creator.', nargs=argparse.REMAINDER,
+    default=[])
+  return parser
+
+
+class Mode(enum.Enum):
+  """
+  The mode of operation that is selected by the command-line options.
+  It is determined once after the options have been validated.
+  """
+
+  dry = 'dry'
+  clean = 'clean'
+  clean_with_dependencies = 'clean_with_dependencies'
+  export = 'export'
+  build = 'build'
+
+  @classmethod
+  def resolve(cls, args):
+    if args.dry:
+      return cls.dry
+    elif args.clean_with_dependencies:
+      return cls.clean_with_dependencies
+    elif args.clean:
+      return cls.clean
+    elif args.export:
+      return cls.export
+    return cls.build
 
 
 def call_subprocess(args, workspace):
+  import creator.utils
+  import subprocess
   workspace.info("running: " + ' '.join(creator.utils.quote(x) for x in args))
-  return subprocess.call(args)
+  # Creator holds no file descriptors that ninja could inherit, so on
+  # Posix we can spare the child closing every possible descriptor.
+  return subprocess.call(args, close_fds=(os.name == 'nt'))
 
 
-def complete_target_list(targets, for_target=None):
+def read_metadata(filename):
+  """
+  Like :func:`creator.utils.read_metadata`, but the result is cached
+  as long as the file's modification time and size are unchanged. Do
+  not modify the returned dictionary.
+  """
+
+  filename = os.path.abspath(filename)
+  st = os.stat(filename)
+  return _read_metadata(filename, st.st_mtime_ns, st.st_size)
+
+
+@functools.lru_cache(maxsize=128)
+def _read_metadata(filename, mtime_ns, size):
+  import creator.utils
+  return creator.utils.read_metadata(filename)
+
+
+def remove_file(filename):
+  """
+  Removes the file *filename* if it exists and is a regular file (or
+  a symbolic link to one). Directories and broken links are skipped.
+
+  Returns:
+    bool: True if the file was removed, False if it was skipped.
+  Raises:
+    OSError: If the file exists but could not be removed.
+  """
+
+  if not os.path.isfile(filename):
+    return False
+  try:
+    os.remove(filename)
+  except FileNotFoundError:
+    return False
+  return True
+
+
+def export_build_file(filename, workspace, unit, targets):
+  """
+  Exports the ninja build definitions to *filename*, see
+  :func:`creator.ninja.export`. A regular file is written to a temporary
+  file first that replaces it when complete, so a failed export does not
+  leave a truncated build file behind. Anything else, like a symbolic
+  link or a device such as ``/dev/stdout``, is written to directly.
+  """
+
+  import creator.ninja
+  import stat
+  try:
+    st = os.lstat(filename)
+  except FileNotFoundError:
+    st = None
+  if st is not None and not stat.S_ISREG(st.st_mode):
+    with open(filename, 'w', buffering=1 << 20) as fp:
+      creator.ninja.export(fp, workspace, unit, targets)
+    return
+
+  temp_file = filename + '.tmp'
+  try:
+    with open(temp_file, 'w', buffering=1 << 20) as fp:
+      creator.ninja.export(fp, workspace, unit, targets)
+    if st is not None:
+      os.chmod(temp_file, stat.S_IMODE(st.st_mode))
+    os.replace(temp_file, filename)
+  except BaseException:
+    try:
+      os.remove(temp_file)
+    except OSError:
+      pass
+    raise
+
+
+def complete_target_list(targets):
   """
   Given a list of *targets*, completes that list in the correct
   order given the dependencies of the specified targets to make
   sure all dependencies are met before executed the *targets*.
+
+  The list is completed in-place. The targets keep the order in
+  which they were specified, and the dependencies of each target
+  that are not already in the list are inserted right before it.
+  Targets are keyed by their identity, never by their hash.
+
+  Raises:
+    RuntimeError: If the dependencies of the targets form a cycle.
   """
 
-  if for_target is None:
-    for target in targets[:]:
-      complete_target_list(targets, target)
-  else:
-    for dep in reversed(for_target.dependencies):
-      if dep in targets:
-        targets.remove(dep)
-      targets.insert(0, dep)
-      complete_target_list(targets, dep)
+  # Depth-first walk with an explicit stack, so deep dependency
+  # chains can not exceed the recursion limit. A target is marked
+  # False while its dependencies are visited and True when done.
+  done = {}
+  result = []
+  for root in targets:
+    if id(root) in done:
+      continue
+    done[id(root)] = False
+    stack = [(root, iter(root.dependencies))]
+    while stack:
+      target, deps = stack[-1]
+      for dep in deps:
+        state = done.get(id(dep))
+        if state is None:
+          done[id(dep)] = False
+          stack.append((dep, iter(dep.dependencies)))
+          break
+        elif not state:
+          raise RuntimeError('cyclic target dependencies')
+      else:
+        stack.pop()
+        done[id(target)] = True
+        result.append(target)
+  targets[:] = result
 
 
 def collapse_target_list(targets):
@@ -106,6 +248,7 @@ def collapse_target_list(targets):
   list of targets that can be built with one ninja invokation.
   """
 
+  import creator.unit
   result = []
   collapased = []
   for target in targets:
@@ -124,8 +267,16 @@ def collapse_target_list(targets):
 def main(argv=None):
   if argv is None:
     argv = sys.argv[1:]
+  parser = get_parser()
   args = parser.parse_args(argv)
 
+  # Import the heavy modules only after the arguments have been parsed
+  # so that --help and usage errors don't pay for them.
+  import creator.macro
+  import creator.ninja
+  import creator.unit
+  import creator.utils
+
   if args.no_export and args.export:
     parser.error('conflicting options -n/--no-export and -e/--export')
   if args.dry and args.export:
@@ -136,30 +287,45 @@ def main(argv=None):
     parser.error('conflicting options -c/--clean and -e/--export')
   if args.clean:
     args.no_export = True
+  mode = Mode.resolve(args)
 
   workspace = creator.unit.Workspace()
   workspace.path.extend(args.unitpath)
 
-  # Evaluate the Defines and Macros passed via the command line.
+  # Evaluate the Defines and Macros passed via the command line. TextNodes
+  # are never modified after construction, so all empty Defines can share
+  # the same node.
+  context = workspace.context
+  TextNode = creator.macro.TextNode
+  empty_text = TextNode('')
   for define in args.define:
     key, _, value = define.partition('=')
     if key:
-      workspace.context[key] = creator.macro.TextNode(value)
+      context[key] = TextNode(value) if value else empty_text
 
   for macro in args.macro:
     key, _, value = macro.partition('=')
     if key:
-      workspace.context[key] = value
+      context[key] = value
 
   # Look at the current directory and figure out the main unit
   # that should be used by this session.
   if not args.unit:
-    if os.path.exists('Creator'):
+    # A single pass over the directory serves all the checks below.
+    names = set()
+    files = []
+    with os.scandir('.') as it:
+      for entry in it:
+        names.add(entry.name)
+        if entry.name.endswith('.creator') and not entry.name.startswith('.') \
+            and entry.is_file():
+          files.append(entry.name)
+
+    if 'Creator' in names:
       filename = 'Creator'
-    elif os.path.exists('.creator'):
+    elif '.creator' in names:
       filename = '.creator'
     else:
-      files = glob.glob('*.creator')
       if not files:
         workspace.error("no 'Creator' or '*.creator' files in current directory")
       elif len(files) > 1:
@@ -167,7 +333,7 @@ def main(argv=None):
           "use -u/--unit to specify which to use.")
       filename = files[0]
 
-    metadata = creator.utils.read_metadata(filename)
+    metadata = read_metadata(filename)
     if not 'creator.unit.name' in metadata:
       workspace.error("'{0}' missing @creator.unit.name".format(filename))
     args.unit = metadata['creator.unit.name']
@@ -177,7 +343,7 @@ def main(argv=None):
   workspace.setup_targets()
 
   # Exit if this is just a dry run.
-  if args.dry:
+  if mode is Mode.dry:
     return 0
 
   # Figure the output path for the build definitions.
@@ -186,8 +352,7 @@ def main(argv=None):
     if args.output:
       args.output = creator.utils.normpath(args.output)
       dirname = os.path.dirname(args.output)
-      if not os.path.isdir(dirname):
-        os.makedirs(dirname)
+      os.makedirs(dirname, exist_ok=True)
       args.output = os.path.relpath(args.output)
   if not args.output:
       args.output = 'build.ninja'
@@ -197,52 +362,61 @@ def main(argv=None):
 
   # We must not complete the target list if we're only cleaning
   # without dependencies.
-  if not args.clean or args.clean_with_dependencies:
+  if mode is not Mode.clean:
     complete_target_list(targets)
 
   # Collect a list of all targets that will be processed by Ninja.
-  ninja_targets = [
-    t.identifier for t in targets if isinstance(t, creator.unit.Target)]
+  Target = creator.unit.Target
+  is_target = [isinstance(t, Target) for t in targets]
+  ninja_targets = [t.identifier for t, ok in zip(targets, is_target) if ok]
 
-  if args.export:
+  if mode is Mode.export:
     # Print a warning for each specified non-buildable target.
-    for target in targets:
-      if isinstance(target, creator.unit.Task):
+    for target, ok in zip(targets, is_target):
+      if not ok:
         workspace.info("warning: {0} is a task".format(target.identifier))
 
   # If there are not targets specified and there are no targets
   # in the workspace, we don't have to export a ninja.build file
   # nor invoke Ninja.
-  if not targets and not ninja_targets:
-    if not any(isinstance(t, creator.unit.Target) for t in workspace.all_targets()):
-      args.dry = True
-      args.no_export = True
+  if not targets and mode in (Mode.export, Mode.build):
+    if not workspace.has_buildable_target():
+      return 0
 
   # If we have any buildable targets specified, no targets specified at
   # all or if we should only export the build definitions, do exactly that.
-  if not args.no_export and (args.export or ninja_targets or not targets):
+  if mode is Mode.export or (mode is Mode.build and not args.no_export
+      and (ninja_targets or not targets)):
     workspace.info("exporting to: {0}".format(args.output))
-    with open(args.output, 'w') as fp:
-      creator.ninja.export(fp, workspace, unit, ninja_targets)
-    if args.export:
+    export_build_file(args.output, workspace, unit, ninja_targets)
+    if mode is Mode.export:
       return 0
 
   # Clean the target output files if --clean or --clean-with-dependencies
   # is specified.
-  if args.clean or args.clean_with_dependencies:
+  if mode in (Mode.clean, Mode.clean_with_dependencies):
     if not targets:
       targets = workspace.all_targets()
+    files = [filename for target in targets if isinstance(target, Target)
+      for entry in target.command_data for filename in entry.outputs]
+
+    # Removing files is I/O bound, so we can overlap the removals. It
+    # doesn't pay off to start the threads for just a few files.
+    if len(files) > 16:
+      import concurrent.futures
+      with concurrent.futures.ThreadPoolExecutor(
+          max_workers=min(32, len(files))) as executor:
+        results = [executor.submit(remove_file, x).result for x in files]
+    else:
+      results = [functools.partial(remove_file, x) for x in files]
+
     cleaned_files = 0
-    for target in targets:
-      if isinstance(target, creator.unit.Target):
-        for entry in target.command_data:
-          for filename in entry['outputs']:
-            if os.path.isfile(filename):
-              try:
-                os.remove(filename)
-                cleaned_files += 1
-              except OSError:
-                workspace.error("Could not remove '{}'.".format(filename))
+    for filename, result in zip(files, results):
+      try:
+        if result():
+          cleaned_files += 1
+      except OSError:
+        workspace.error("Could not remove '{}'.".format(filename))
     workspace.info('Cleaned {} files.'.format(cleaned_files))
     return 0
 
@@ -251,19 +425,19 @@ def main(argv=None):
     ninja_args.append('-v')
 
   # No targets specified on the command-line? Build it all.
-  if not targets and not args.dry:
+  if not targets:
     return call_subprocess(ninja_args, workspace)
   else:
     targets = collapse_target_list(targets)
 
-    # Run each target with its own call to ninja and the tasks in between.
+    # Run each run of subsequent targets with one call to ninja and
+    # the tasks in between.
     for target in targets:
       if isinstance(target, creator.unit.Task):
         workspace.info("running task '{0}'".format(target.identifier))
         target.func()
       elif isinstance(target, list):
         idents = [creator.ninja.ident(t.identifier) for t in target]
-        idents = [creator.utils.quote(x) for x in idents]
         res = call_subprocess(ninja_args + idents, workspace)
         if res != 0:
           return res
@@ -271,5 +445,16 @@ def main(argv=None):
     return 0
 
 
+def __getattr__(name):
+  # These names used to be module-level globals. They are resolved on
+  # demand so that importing this module stays cheap.
+  if name == 'parser':
+    return get_parser()
+  elif name == 'term_print':
+    from creator.utils import term_print
+    return term_print
+  raise AttributeError("module {0!r} has no attribute {1!r}".format(__name__, name))
+
+
 if __name__ == "__main__":
   sys.exit(main())
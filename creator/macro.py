@@ -20,6 +20,7 @@
 
 import creator.utils
 import abc
+import functools
 import glob2
 import os
 import string
@@ -36,6 +37,8 @@ class ContextProvider(object, metaclass=abc.ABCMeta):
   contains the project files.
   """
 
+  __slots__ = ('__weakref__',)
+
   @abc.abstractmethod
   def has_macro(self, name):
     """
@@ -55,6 +58,9 @@ class ContextProvider(object, metaclass=abc.ABCMeta):
       default (any): The default value to be returned if the macro
         can not be served. The default value is :class:`NotImplemented`
         which causes this function to raise a :class:`KeyError` instead.
+        Passing None is the cheapest way to look up a macro that may
+        not exist, as it requires neither exception handling nor a
+        separate :meth:`has_macro` call.
     Returns:
       ExpressionNode: The macro associated with the specified *name*.
     Raises:
@@ -89,6 +95,8 @@ class MutableContext(ContextProvider):
       mapping the macro names with the actual macro objects.
   """
 
+  __slots__ = ('macros',)
+
   def __init__(self):
     super().__init__()
     self.macros = {}
@@ -96,7 +104,7 @@ class MutableContext(ContextProvider):
   def __setitem__(self, name, value):
     if isinstance(value, str):
       value = parse(value, self)
-    elif not isinstance(value, ExpressionNode):
+    elif not is_node(value):
       message = 'value must be str or ExpressionNode'
       raise TypeError(message, type(value))
     # Make sure the macro does not contain a reference to itself.
@@ -140,8 +148,9 @@ class MutableContext(ContextProvider):
     return name in self.macros
 
   def get_macro(self, name, default=NotImplemented):
-    if name in self.macros:
-      return self.macros[name]
+    macro = self.macros.get(name)
+    if macro is not None:
+      return macro
     elif default is not NotImplemented:
       return default
     else:
@@ -156,6 +165,8 @@ class ChainContext(ContextProvider):
   This context chains multiple :class:`ContextProvider`s.
   """
 
+  __slots__ = ('contexts',)
+
   def __init__(self, *contexts):
     super().__init__()
     self.contexts = []
@@ -166,17 +177,13 @@ class ChainContext(ContextProvider):
         self.contexts.append(context)
 
   def has_macro(self, name):
-    for context in self.contexts:
-      if contexts.has_macro(name):
-        return True
-    return False
+    return self.get_macro(name, None) is not None
 
   def get_macro(self, name, default=NotImplemented):
     for context in self.contexts:
-      try:
-        return context.get_macro(name)
-      except KeyError:
-        pass
+      macro = context.get_macro(name, None)
+      if macro is not None:
+        return macro
     if default is NotImplemented:
       raise KeyError(name)
     return default
@@ -201,6 +208,8 @@ class StackFrameContext(ContextProvider):
       exposed by this context.
   """
 
+  __slots__ = ('frame',)
+
   def __init__(self, stack_depth=0):
     super().__init__()
     frame = sys._getframe()
@@ -209,11 +218,7 @@ class StackFrameContext(ContextProvider):
     self.frame = frame
 
   def has_macro(self, name):
-    try:
-      self.get_macro(name)
-    except KeyError:
-      return False
-    return True
+    return self.get_macro(name, None) is not None
 
   def get_macro(self, name, default=NotImplemented):
     frame = self.frame
@@ -228,7 +233,9 @@ class StackFrameContext(ContextProvider):
 
     if isinstance(value, str):
       value = creator.macro.TextNode(str(value))
-    if not isinstance(value, creator.macro.ExpressionNode):
+    elif not is_node(value):
+      if default is not NotImplemented:
+        return default
       raise KeyError(name)
 
     return value
@@ -399,9 +406,8 @@ class VarNode(ExpressionNode):
       return args[arg_index].eval(context, sub_args).strip()
 
     # Try to get the macro and evaluate it.
-    try:
-      macro = context.get_macro(self.varname)
-    except KeyError:
+    macro = context.get_macro(self.varname, None)
+    if macro is None:
       return ''
     return macro.eval(context, sub_args).strip()
 
@@ -421,6 +427,54 @@ class VarNode(ExpressionNode):
     return VarNode(self.varname, args, new_context)
 
 
+class LazyNode(ExpressionNode):
+  """
+  This expression node wraps macro text that is only parsed when the
+  node is evaluated or copied for the first time. Substitutions that
+  are applied before that are remembered and applied to the parsed
+  expression.
+
+  Attributes:
+    text (str): The macro text.
+  """
+
+  def __init__(self, text, context):
+    if not isinstance(text, str):
+      raise TypeError('text must be str', type(text))
+    super().__init__()
+    self.text = text
+    self.context = weakref.ref(context)
+    self._node = None
+    self._substitutions = []
+
+  def get_node(self):
+    """
+    Returns:
+      ExpressionNode: The parsed expression.
+    """
+
+    if self._node is None:
+      node = parse(self.text, self.context())
+      for ref_name, sub_node in self._substitutions:
+        node = node.substitute(ref_name, sub_node)
+      self._node = node
+      self._substitutions = None
+    return self._node
+
+  def eval(self, context, args):
+    return self.get_node().eval(context, args)
+
+  def substitute(self, ref_name, node):
+    if self._node is None:
+      self._substitutions.append((ref_name, node))
+    else:
+      self._node = self._node.substitute(ref_name, node)
+    return self
+
+  def copy(self, new_context):
+    return self.get_node().copy(new_context)
+
+
 class Function(ExpressionNode):
   """
   This class can be used to wrap a Python function to make it a
@@ -446,6 +500,19 @@ class Function(ExpressionNode):
     return self
 
 
+def is_node(value):
+  """
+  Returns True if *value* is an :class:`ExpressionNode`. The node classes
+  of this module are checked by their exact type first, which is a lot
+  faster than :func:`isinstance` with the abstract base class.
+  """
+
+  return type(value) in _node_types or isinstance(value, ExpressionNode)
+
+
+_node_types = frozenset([TextNode, ConcatNode, VarNode, LazyNode, Function])
+
+
 class Parser(object):
   """
   This class implements the process of parsing a string into an
@@ -575,7 +642,36 @@ class Parser(object):
 
 
 parser = Parser()
-parse = parser.parse
+
+
+def parse(text, context):
+  """
+  Parses *text* into an expression tree bound to *context*, like
+  :meth:`Parser.parse`. The syntax tree of every text is only built once
+  and then copied for each context, which is a lot cheaper than parsing
+  the text again.
+
+  Args:
+    text (str): The text to parse into an expression tree.
+    context (ContextProvider): The context to bind the tree to.
+  Returns:
+    ExpressionNode: The root node of the hierarchy.
+  """
+
+  if context is not None and not isinstance(context, ContextProvider):
+    raise TypeError('context must be None or ContextProvider', type(context))
+  return _parse_template(text).copy(context)
+
+
+@functools.lru_cache(maxsize=4096)
+def _parse_template(text):
+  # The template is never evaluated, it is only copied by parse().
+  # Nodes are modified in place by substitute(), so it must never be
+  # handed out directly.
+  return parser.parse(text, _template_context)
+
+
+_template_context = MutableContext()
 
 
 class Globals:
@@ -41,7 +41,10 @@ def export(fp, workspace, unit, default_targets=()):
     ValueError: If any of the targets do not exist.
   """
 
-  writer = Writer(fp, width=1024)
+  # The writer issues a write() for every line. Collect the chunks and
+  # pass them to *fp* in a single call at the end.
+  chunks = []
+  writer = Writer(_ChunkOutput(chunks.append), width=1024)
 
   for unit in sorted(workspace.units.values(), key=lambda x: x.identifier):
     if not unit.targets:
@@ -65,11 +68,13 @@ def export(fp, workspace, unit, default_targets=()):
 
       # Append all output files of the target to the defaults.
       for entry in targets[varname].command_data:
-        defaults |= set(entry['outputs'])
+        defaults.update(entry.outputs)
 
     # Write the defaults.
     writer.default(list(defaults))
 
+  fp.write(''.join(chunks))
+
 
 def ident(s):
   """
@@ -77,4 +82,17 @@ def ident(s):
   ninja by replacing all invalid characters with an underscore.
   """
 
-  return re.sub('[^A-Za-z0-9_]+', '_', s)
+  return _ident_regex.sub('_', s)
+
+
+_ident_regex = re.compile('[^A-Za-z0-9_]+')
+
+
+class _ChunkOutput(object):
+  """
+  Private. Minimal file-like object for the ninja :class:`Writer` that
+  passes everything written to it to the *write* callable.
+  """
+
+  def __init__(self, write):
+    self.write = write
@@ -20,14 +20,23 @@
 
 import creator.macro
 import creator.ninja
+import creator.platform
 import creator.utils
+import collections
+import functools
+import hashlib
+import importlib.util
+import json
+import marshal
+import operator
 import os
+import re
 import shlex
+import stat
 import subprocess
 import sys
 import types
 import warnings
-import weakref
 
 from creator.macro import TextNode as raw
 from creator.utils import term_print
@@ -37,6 +46,166 @@ class UnitNotFoundError(Exception):
   pass
 
 
+def _shlex_split(command):
+  """
+  Private. Splits *command* like :func:`shlex.split`. Commands without
+  quotes or escapes are split with a regular expression, all others are
+  tokenized by :mod:`shlex` and cached.
+  """
+
+  if not _shlex_special.search(command):
+    return _shlex_plain.findall(command)
+  return list(_shlex_split_cached(command))
+
+
+@functools.lru_cache(maxsize=1024)
+def _shlex_split_cached(command):
+  return tuple(shlex.split(command))
+
+
+_shlex_special = re.compile('[\'"\\\\]')
+_shlex_plain = re.compile('[^ \t\r\n]+')
+
+
+def _split_simple_command(command):
+  """
+  Private. Returns the arguments of *command* if it is a simple command
+  that can be executed without a shell with the same effect, otherwise
+  None. Commands that use any shell syntax other than quoting, variable
+  assignments or shell builtins and keywords must run in a shell.
+  """
+
+  if os.name != 'posix' or _shell_special.search(command):
+    return None
+  try:
+    args = _shlex_split(command)
+  except ValueError:
+    return None
+  if not args or '=' in args[0] or args[0] in _shell_words:
+    return None
+  return args
+
+
+_shell_special = re.compile('[;&|<>()$`*?\\[\\]{}~!#\\n]')
+_shell_words = frozenset([
+  '.', ':', 'alias', 'bg', 'break', 'case', 'cd', 'command', 'continue',
+  'do', 'done', 'elif', 'else', 'esac', 'eval', 'exec', 'exit', 'export',
+  'fg', 'fi', 'for', 'getopts', 'hash', 'if', 'in', 'jobs', 'local',
+  'read', 'readonly', 'return', 'set', 'shift', 'source', 'then', 'time',
+  'times', 'trap', 'type', 'ulimit', 'umask', 'unalias', 'unset', 'until',
+  'wait', 'while'])
+
+
+def _compile_unit_script(filename, code_cache=None, optimize=-1):
+  """
+  Private. Compiles the unit script at *filename* and returns the code
+  object. Compiled code is cached in ``~/.creator/bytecode``, keyed by
+  the filename and the *optimize* level and validated with the
+  modification time and size of the script, similar to how Python caches
+  compiled modules. If a *code_cache* dictionary is specified, it is used
+  as an in-memory cache in front of that. An *optimize* level of -1
+  selects the level of the interpreter, like :func:`compile` does.
+  """
+
+  # Cache the code under the level it is actually compiled with.
+  if optimize < 0:
+    optimize = sys.flags.optimize
+  st = os.stat(filename)
+  key = (filename, st.st_mtime_ns, st.st_size, optimize)
+  if code_cache is not None and key in code_cache:
+    return code_cache[key]
+  code = _load_unit_script(filename, st, optimize)
+  if code_cache is not None:
+    code_cache[key] = code
+  return code
+
+
+def _load_unit_script(filename, st, optimize):
+  """
+  Private. Helper for :func:`_compile_unit_script` that reads the
+  compiled code from the bytecode cache or compiles the script.
+  """
+
+  header = importlib.util.MAGIC_NUMBER + \
+    st.st_mtime_ns.to_bytes(8, 'little') + st.st_size.to_bytes(8, 'little')
+  cache_name = hashlib.sha1(filename.encode('utf8', 'surrogateescape')).hexdigest()
+  if optimize:
+    cache_name += '.opt-{0}'.format(optimize)
+  cache_file = os.path.join(
+    os.path.expanduser('~'), '.creator', 'bytecode', cache_name + '.pyc')
+
+  try:
+    with open(cache_file, 'rb') as fp:
+      data = fp.read()
+  except OSError:
+    pass
+  else:
+    if data.startswith(header):
+      try:
+        return marshal.loads(data[len(header):])
+      except (EOFError, ValueError, TypeError):
+        pass
+
+  # Reading bytes lets compile() decode the source, honoring an encoding
+  # declaration in the script.
+  with open(filename, 'rb') as fp:
+    code = compile(fp.read(), filename, 'exec', dont_inherit=True,
+      optimize=optimize)
+
+  # Failing to write the cache is not an error, it will just be
+  # compiled again next time.
+  try:
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+    with open(temp_file, 'wb') as fp:
+      fp.write(header + marshal.dumps(code))
+    os.replace(temp_file, cache_file)
+  except OSError:
+    pass
+  return code
+
+
+def _metadata_cache_file():
+  return os.path.join(os.path.expanduser('~'), '.creator', 'metadata.json')
+
+
+def _read_metadata_cache():
+  """
+  Private. Reads the unit identifiers that a previous invocation read
+  from unit scripts. Returns a dictionary in the format of
+  :attr:`Workspace._metadata_cache`, which is empty if there is no
+  usable cache file.
+  """
+
+  try:
+    with open(_metadata_cache_file()) as fp:
+      data = json.load(fp)
+    if data.get('version') != 1:
+      return {}
+    return {k: tuple(v) for k, v in data['files'].items()}
+  except (OSError, ValueError, KeyError, TypeError, AttributeError):
+    return {}
+
+
+def _write_metadata_cache(cache):
+  """
+  Private. Saves the metadata *cache* for the next invocation. Files
+  without an identifier are left out so that their warning is repeated.
+  Failing to write the cache is not an error.
+  """
+
+  files = {k: v for k, v in cache.items() if v[2] is not None}
+  cache_file = _metadata_cache_file()
+  try:
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    temp_file = '{0}.{1}.tmp'.format(cache_file, os.getpid())
+    with open(temp_file, 'w') as fp:
+      json.dump({'version': 1, 'files': files}, fp)
+    os.replace(temp_file, cache_file)
+  except OSError:
+    pass
+
+
 class Workspace(object):
   """
   The *Workspace* is basically the root of a *Creator* build session.
@@ -45,22 +214,32 @@ class Workspace(object):
   Attributes:
     path (list of str): A list of directory names in which unit scripts
       are being searched for. The unit scripts will actually also be
-      searched in subdirectories of the specified paths.
+      searched in the direct, non-hidden subdirectories of the specified
+      paths.
     context (ContextProvider): The global macro context.
     units (dict of str -> Unit): A dictionary that maps the full
       identifier of a :class:`Unit` to the actual object.
     statics (dict of str -> Unit): A dictionary that maps the full
       normalized filenames of static creator files.
+    optimize (int): The optimization level that unit scripts are compiled
+      with, see :func:`compile`. Defaults to -1, the level of the
+      interpreter, so ``python -O`` strips asserts from unit scripts.
   """
 
   def __init__(self):
     super().__init__()
-    self.path = ['.']
-    self.path.append(os.path.join(os.path.dirname(__file__), 'builtins'))
-    self.path.extend(os.getenv('CREATORPATH', '').split(os.pathsep))
+    # Empty CREATORPATH entries would only repeat the current directory.
+    self.path = ['.', os.path.join(os.path.dirname(__file__), 'builtins')]
+    creatorpath = os.environ.get('CREATORPATH', '')
+    self.path += [x for x in creatorpath.split(os.pathsep) if x]
     self.context = WorkspaceContext(self)
     self.units = {}
     self.statics = {}
+    self.optimize = -1
+    # Compiled unit scripts, see _compile_unit_script().
+    self._code_cache = {}
+    # Maps unit directories to their .creator_profile or None.
+    self._profiles = {}
 
     # If the current user has a `.creator_profile` file in his
     # home directory, run that file.
@@ -68,26 +247,30 @@ class Workspace(object):
     if os.path.isfile(filename):
       self.run_static_unit(filename)
 
-    # Cache for the metadata that was read from .creator files.
+    # Maps the filenames of .creator files to a tuple of their
+    # modification time, size and the unit identifier read from them
+    # (which can be None if the file does not specify one). It is kept in
+    # ~/.creator/metadata.json between invocations, see _scan_path().
     self._metadata_cache = {}
     self._ident_cache = {}
 
-  def info(self, *args, **kwargs):
-    kwargs.setdefault('fg', 'cyan')
+    # The search path and the modification times of the directories
+    # that were scanned to fill the identifier cache. None until the
+    # first scan.
+    self._scanned_path = None
+    self._path_mtimes = None
+
+  def info(self, *args, fg='cyan', **kwargs):
     # kwargs.setdefault('file', sys.stderr)
-    term_print('==> creator:', *args, **kwargs)
+    term_print('==> creator:', *args, fg=fg, **kwargs)
 
-  def warn(self, *args, **kwargs):
-    kwargs.setdefault('fg', 'magenta')
+  def warn(self, *args, fg='magenta', **kwargs):
     # kwargs.setdefault('file', sys.stderr)
-    term_print('==> creator:', *args, **kwargs)
+    term_print('==> creator:', *args, fg=fg, **kwargs)
 
-  def error(self, *args, **kwargs):
-    exit = kwargs.pop('exit', 1)
-    kwargs.setdefault('fg', 'red')
-    kwargs.setdefault('attr', ('bright',))
+  def error(self, *args, exit=1, fg='red', attr=('bright',), **kwargs):
     # kwargs.setdefault('file', sys.stderr)
-    term_print('==> creator:', *args, **kwargs)
+    term_print('==> creator:', *args, fg=fg, attr=attr, **kwargs)
     if exit is not None:
       sys.exit(1)
 
@@ -101,6 +284,10 @@ class Workspace(object):
       Unit: The unit executed.
     """
 
+    # The keys are normalized, so a hit means *filename* is already
+    # normalized and there is no need to do it again.
+    if filename in self.statics:
+      return self.statics[filename]
     filename = creator.utils.normpath(filename)
     if filename in self.statics:
       return self.statics[filename]
@@ -142,38 +329,164 @@ class Workspace(object):
     filename = self._ident_cache.get(identifier)
     if filename is not None:
       return filename
-    if not allow_recache:
+    if not allow_recache or not self._path_changed():
       raise UnitNotFoundError(identifier)
 
-    def check_file(path):
-      path = creator.utils.normpath(path)
-      if path.endswith('.creator') or os.path.basename(path) == 'Creator':
-        metadata = self._metadata_cache.get(path)
-        if metadata is None:
-          metadata = creator.utils.read_metadata(path)
-          if 'creator.unit.name' not in metadata:
-            self.warn("'{0}' missing @creator.unit.name".format(path))
-          self._metadata_cache[path] = metadata
-
-        ident = metadata.get('creator.unit.name')
-        if ident is not None:
-          self._ident_cache[ident] = path
-
-    # Re-generate the identifier cacheself.
-    for dirname in self.path:
-      if not os.path.isdir(dirname):
-        continue
-
-      for path in creator.utils.abs_listdir(dirname):
-        if os.path.isfile(path):
-          check_file(path)
-        elif os.path.isdir(path):
-          for path in creator.utils.abs_listdir(path):
-            if os.path.isfile(path):
-              check_file(path)
-
+    self._scan_path()
     return self.find_unit(identifier, allow_recache=False)
 
+  def invalidate_unit_cache(self):
+    """
+    Forgets the unit identifiers found in the search :attr:`path` so
+    that the next :meth:`find_unit` call scans it again. Use this if
+    unit files may have changed in a way that does not change the
+    modification time of their directory, eg. when the identifier in
+    an existing file was edited. The metadata of files that did not
+    change is still re-used.
+    """
+
+    self._ident_cache.clear()
+    self._profiles.clear()
+    self._scanned_path = None
+    self._path_mtimes = None
+
+  def _path_changed(self):
+    """
+    Returns:
+      bool: True if the search :attr:`path` has not been scanned yet or
+      if it might contain new units since the last scan, False if none
+      of the scanned directories changed.
+    """
+
+    if self._path_mtimes is None or self._scanned_path != self.path:
+      return True
+    for dirname, mtime in self._path_mtimes.items():
+      try:
+        if os.stat(dirname).st_mtime_ns != mtime:
+          return True
+      except OSError:
+        if mtime is not None:
+          return True
+    return False
+
+  def _scan_path(self):
+    """
+    Re-generates the identifier cache from all .creator and Creator files
+    in the search :attr:`path` and their direct, non-hidden subdirectories.
+    The modification time of every scanned directory is recorded so that
+    :meth:`_path_changed` can tell when another scan is necessary.
+    """
+
+    def is_unit_file(name):
+      return name.endswith('.creator') or name == 'Creator'
+
+    def add_file(dirname, entry, files):
+      # The *dirname* is already normalized and the name of a directory
+      # entry never contains a separator, so joining them is enough.
+      st = entry.stat()
+      files.append((os.path.join(dirname, entry.name), st.st_mtime_ns, st.st_size))
+
+    def scan_dir(dirname):
+      # Runs in a worker thread, thus it must not modify the caches.
+      files = []
+      mtimes = {}
+      # The stat() result for the modification time also tells whether
+      # the path is a directory, no need for os.path.isdir().
+      try:
+        st = os.stat(dirname)
+      except OSError:
+        mtimes[dirname] = None
+        return files, mtimes
+      mtimes[dirname] = st.st_mtime_ns
+      if not stat.S_ISDIR(st.st_mode):
+        return files, mtimes
+
+      # The file type information of the directory entries is usually
+      # available without another stat(). The file names are checked
+      # first as most entries will not be unit files. Hidden directories
+      # (eg. .git) are not searched for units.
+      base = creator.utils.normpath(dirname)
+      with os.scandir(dirname) as entries:
+        for entry in entries:
+          if entry.is_file():
+            if is_unit_file(entry.name):
+              add_file(base, entry, files)
+          elif entry.is_dir() and not entry.name.startswith('.'):
+            mtimes[entry.path] = entry.stat().st_mtime_ns
+            subbase = os.path.join(base, entry.name)
+            with os.scandir(entry.path) as subentries:
+              for subentry in subentries:
+                if is_unit_file(subentry.name) and subentry.is_file():
+                  add_file(subbase, subentry, files)
+      return files, mtimes
+
+    def read_ident(filename):
+      return creator.utils.read_metadata(filename).get('creator.unit.name')
+
+    # List the directories concurrently so that the directory listings
+    # overlap, but keep the results in the order of the search path so
+    # that later directories still take precedence.
+    path = list(self.path)
+    if len(path) > 1:
+      import concurrent.futures
+      with concurrent.futures.ThreadPoolExecutor(min(8, len(path))) as pool:
+        results = list(pool.map(scan_dir, path))
+    else:
+      results = [scan_dir(x) for x in path]
+
+    files = []
+    path_mtimes = {}
+    for dir_files, mtimes in results:
+      files.extend(dir_files)
+      path_mtimes.update(mtimes)
+
+    # Only re-read files that changed since they were last read, also
+    # by a previous invocation. Reading many files is latency bound, so
+    # they are read in parallel. The same file can be found through more
+    # than one search path.
+    cache = self._metadata_cache
+    if not cache:
+      cache.update(_read_metadata_cache())
+    stale = {}
+    for filename, mtime, size in files:
+      cached = cache.get(filename)
+      if cached is None or cached[:2] != (mtime, size):
+        stale[filename] = (filename, mtime, size)
+    stale = list(stale.values())
+    if len(stale) > 16:
+      import concurrent.futures
+      with concurrent.futures.ThreadPoolExecutor(min(32, len(stale))) as pool:
+        idents = list(pool.map(read_ident, [x[0] for x in stale]))
+    else:
+      idents = [read_ident(x[0]) for x in stale]
+
+    for (filename, mtime, size), ident in zip(stale, idents):
+      # Files without a unit name are remembered, too, so the warning
+      # is not repeated for every scan.
+      if ident is None:
+        self.warn("'{0}' missing @creator.unit.name".format(filename))
+      cache[filename] = (mtime, size, ident)
+
+    # Forget files that were removed from the scanned directories. The
+    # entries of other directories may still be used by other projects.
+    found = set(x[0] for x in files)
+    scanned = set(creator.utils.normpath(k)
+      for k, v in path_mtimes.items() if v is not None)
+    removed = [k for k in cache if k not in found
+      and os.path.dirname(k) in scanned]
+    for filename in removed:
+      del cache[filename]
+    if stale or removed:
+      _write_metadata_cache(cache)
+
+    for filename, mtime, size in files:
+      ident = cache[filename][2]
+      if ident is not None:
+        self._ident_cache[ident] = filename
+
+    self._scanned_path = path
+    self._path_mtimes = path_mtimes
+
   def load_unit(self, identifier):
     """
     If the unit with the specified *identifier* is not already loaded,
@@ -191,13 +504,20 @@ class Workspace(object):
     if identifier in self.units:
       return self.units[identifier]
 
+    # The identifier cache only contains normalized absolute paths.
     filename = self.find_unit(identifier)
-    filename = os.path.abspath(filename)
 
-    # Execute the .creator_profile file in the current directory.
+    # Execute the .creator_profile file in the current directory. Many
+    # units share a directory, so its presence is only checked once.
     dirname = os.path.dirname(filename)
-    profile = os.path.join(dirname, '.creator_profile')
-    if os.path.isfile(profile):
+    try:
+      profile = self._profiles[dirname]
+    except KeyError:
+      profile = os.path.join(dirname, '.creator_profile')
+      if not os.path.isfile(profile):
+        profile = None
+      self._profiles[dirname] = profile
+    if profile is not None:
       self.run_static_unit(profile)
 
     # Run the unit that we found.
@@ -228,10 +548,9 @@ class Workspace(object):
     Sets up all targets in the workspace.
     """
 
-    for unit in self.units.values():
-      for target in unit.targets.values():
-        if not target.is_setup and not target.abstract:
-          target.do_setup()
+    for target in self._iter_targets():
+      if not target.is_setup:
+        target.do_setup()
 
   def all_targets(self):
     """
@@ -241,13 +560,28 @@ class Workspace(object):
         identifier. Abstract targets will be ignored.
     """
 
-    results = []
+    return sorted(self._iter_targets(), key=operator.attrgetter('identifier'))
+
+  def has_buildable_target(self):
+    """
+    Returns:
+      bool: True if there is at least one non-abstract :class:`Target`
+        declared in the Workspace, False if there are only tasks or
+        no targets at all.
+    """
+
+    return any(isinstance(t, Target) for t in self._iter_targets())
+
+  def _iter_targets(self):
+    """
+    Private. Yields all non-abstract targets of the workspace in no
+    particular order.
+    """
+
     for unit in self.units.values():
       for target in unit.targets.values():
         if not target.abstract:
-          results.append(target)
-    results.sort(key=lambda x: x.identifier)
-    return results
+          yield target
 
 
 class Unit(object):
@@ -278,14 +612,27 @@ class Unit(object):
   """
 
   def __init__(self, project_path, identifier, workspace):
+    if not isinstance(workspace, Workspace):
+      raise TypeError('workspace must be Workspace instance', type(workspace))
     super().__init__()
     self.project_path = project_path
     self.identifier = identifier
     self.workspace = workspace
-    self.aliases = {'self': self.identifier}
+    self.aliases = {'self': identifier}
     self.targets = {}
     self.context = UnitContext(self)
     self.scope = self._create_scope()
+    # Cache for expressions parsed by eval() in the unit context.
+    self._macro_cache = {}
+
+  # The part of the unit script scope that is the same for every unit.
+  _static_scope = {
+    'exit': sys.exit,
+    'join': creator.utils.join,
+    'raw': creator.macro.TextNode,
+    'split': creator.utils.split,
+    'ExitCodeError': creator.utils.ShellCall.ExitCodeError,
+  }
 
   def _create_scope(self):
     """
@@ -293,7 +640,8 @@ class Unit(object):
     unit script which can be executed with :meth:`run_unit_script`.
     """
 
-    return {
+    scope = dict(self._static_scope)
+    scope.update({
       'unit': self,
       'workspace': self.workspace,
       'C': self.context,
@@ -308,20 +656,16 @@ class Unit(object):
       'error': self.error,
       'ne': self.ne,
       'eval': self.eval,
-      'exit': sys.exit,
       'extends': self.extends,
       'info': self.info,
-      'join': creator.utils.join,
       'load': self.load,
-      'raw': creator.macro.TextNode,
-      'split': creator.utils.split,
       'shell': self.shell,
       'shell_get': self.shell_get,
       'target': self.target,
       'task': self.task,
       'warn': self.warn,
-      'ExitCodeError': creator.utils.ShellCall.ExitCodeError,
-    }
+    })
+    return scope
 
   def get_identifier(self):
     return self._identifier
@@ -333,14 +677,13 @@ class Unit(object):
       if not creator.utils.validate_identifier(identifier):
         raise ValueError('invalid unit identifier', identifier)
     self._identifier = identifier
-
-  def get_workspace(self):
-    return self._workspace()
-
-  def set_workspace(self, workspace):
-    if not isinstance(workspace, Workspace):
-      raise TypeError('workspace must be Workspace instance', type(workspace))
-    self._workspace = weakref.ref(workspace)
+    self._log_prefix = '[{0}]'.format(identifier)
+    # The unit context prepares macro names with the identifier and
+    # caches the results. It does not exist yet during __init__().
+    context = getattr(self, 'context', None)
+    if context is not None:
+      context._identifier = identifier
+      context._prepared_names.clear()
 
   def get_target(self, target):
     """
@@ -368,8 +711,9 @@ class Unit(object):
     Executes the Python unit script at *filename* for this unit.
     """
 
-    with open(filename) as fp:
-      code = compile(fp.read(), filename, 'exec', dont_inherit=True)
+    workspace = self.workspace
+    code = _compile_unit_script(filename, workspace._code_cache,
+      workspace.optimize)
     self.scope['__file__'] = filename
     self.scope['__name__'] = '__creator__'
     exec(code, self.scope)
@@ -378,7 +722,6 @@ class Unit(object):
     return self._identifier.startswith('static|')
 
   identifier = property(get_identifier, set_identifier)
-  workspace = property(get_workspace, set_workspace)
 
   def run_task(self, task_name):
     """
@@ -396,18 +739,33 @@ class Unit(object):
     else:
       targets = self.workspace.get_unit(namespace).targets
 
-    try:
-      task = targets[task_name]
-      if not isinstance(task, Task):
-        raise KeyError(task_name)
-    except KeyError:
+    task = targets.get(varname)
+    if not isinstance(task, Task):
       raise ValueError('no such task', task_name)
 
     return task.func()
 
   def append(self, name, value):
-    # todo: This is a rather dirty implementation. :-)
-    self.define(name, '${' + name + '}' + value)
+    """
+    Appends *value* to the macro *name* of this unit. The reference to
+    *name* is replaced by its current value when the macro is set, so
+    neither the old value nor *value* needs to be parsed again.
+    """
+
+    context = self.context
+    nodes = [creator.macro.VarNode(name, [], context)]
+    if isinstance(value, str):
+      # Leading whitespace separates the value from the current one, the
+      # parser would strip it.
+      value = value.rstrip()
+      text = value.lstrip()
+      if len(text) < len(value):
+        nodes.append(raw(value[:len(value) - len(text)]))
+      if text:
+        nodes.append(creator.macro.parse(text, context))
+    else:
+      nodes.append(value)
+    context[name] = creator.macro.ConcatNode(nodes)
 
   def confirm(self, text):
     """
@@ -465,13 +823,26 @@ class Unit(object):
       str: The result of the evaluation.
     """
 
+    # Text without macros or escapes evaluates to itself, no matter
+    # which context it is evaluated in.
+    if '$' not in text and '\\' not in text:
+      return text.strip()
+
     if supp_context:
       context = creator.macro.ChainContext(self.context)
       context.contexts.insert(0, supp_context)
-    else:
-      context = self.context
-    macro = creator.macro.parse(text, context)
-    return macro.eval(context, [])
+      macro = creator.macro.parse(text, context)
+      return macro.eval(context, [])
+
+    # Parsing only depends on the text and the context the expression
+    # is bound to, so the expressions bound to the unit context can be
+    # re-used.
+    macro = self._macro_cache.get(text)
+    if macro is None:
+      if len(self._macro_cache) >= 4096:
+        self._macro_cache.clear()
+      macro = self._macro_cache[text] = creator.macro.parse(text, self.context)
+    return macro.eval(self.context, [])
 
   def extends(self, identifier, inherit_targets=True):
     """
@@ -489,9 +860,11 @@ class Unit(object):
     """
 
     unit = self.load(identifier)
-    for key, value in list(unit.context.items()):
-      if key not in ('ProjectPath', 'self'):
-        self.context.transition(key, value)
+    # The preset macros of a unit must not be inherited.
+    transition = self.context.transition
+    for key, value in unit.context.items():
+      if key not in _unit_presets:
+        transition(key, value)
 
     for key, value in unit.aliases.items():
       self.aliases[key] = value
@@ -503,40 +876,37 @@ class Unit(object):
         self.targets[name] = clone
 
       # Replace abstract dependencies with the non-abstract clones.
-      for target in self.targets.values():
-        for index, dep in enumerate(target.dependencies):
-          for name, ref in unit.targets.items():
-            if ref.abstract and ref is dep:
-              dep = target.dependencies[index] = self.targets[name]
+      abstract_names = {id(ref): name for name, ref in unit.targets.items()
+                        if ref.abstract}
+      if abstract_names:
+        for target in self.targets.values():
+          dependencies = target.dependencies
+          for index, dep in enumerate(dependencies):
+            name = abstract_names.get(id(dep))
+            if name is not None:
+              dependencies[index] = self.targets[name]
 
     return unit
 
-  def info(self, *args, **kwargs):
-    kwargs['fg'] = kwargs.pop('color', 'cyan')
-    items = []
-    for arg in args:
-      if isinstance(arg, str):
-        arg = self.eval(arg)
-      items.append(arg)
-    self.workspace.info('[{0}]'.format(self.identifier), *items, **kwargs)
-
-  def warn(self, *args, **kwargs):
-    kwargs['fg'] = kwargs.pop('color', 'magenta')
-    items = []
-    for arg in args:
-      if isinstance(arg, str):
-        arg = self.eval(arg)
-      items.append(arg)
-    self.workspace.info('[{0}]'.format(self.identifier), *items, **kwargs)
-
-  def error(self, *args, **kwargs):
-    kwargs['fg'] = kwargs.pop('color', 'red')
-    items = []
-    for arg in args:
-      if isinstance(arg, str):
-        arg = self.eval(arg)
-      items.append(arg)
-    self.workspace.info('[{0}]'.format(self.identifier), *items, **kwargs)
+  def _log(self, color, args, kwargs):
+    """
+    Private. Evaluates the string *args* and prints them prefixed with
+    the unit identifier.
+    """
+
+    kwargs['fg'] = color
+    evaluate = self.eval
+    items = [evaluate(x) if isinstance(x, str) else x for x in args]
+    self.workspace.info(self._log_prefix, *items, **kwargs)
+
+  def info(self, *args, color='cyan', **kwargs):
+    self._log(color, args, kwargs)
+
+  def warn(self, *args, color='magenta', **kwargs):
+    self._log(color, args, kwargs)
+
+  def error(self, *args, color='red', **kwargs):
+    self._log(color, args, kwargs)
 
   def load(self, identifier, alias=None):
     """
@@ -568,8 +938,17 @@ class Unit(object):
     """
 
     command = self.eval(command)
-    if not shell:
-      command = shlex.split(command)
+    if shell:
+      # Simple commands do not need a shell process in between. If the
+      # program can not be executed, the shell reports the error.
+      args = _split_simple_command(command)
+      if args is not None:
+        try:
+          return subprocess.call(args, cwd=cwd)
+        except OSError:
+          pass
+    else:
+      command = _shlex_split(command)
     return subprocess.call(command, shell=shell, cwd=cwd)
 
   def shell_get(self, command, shell=True, cwd=None):
@@ -582,8 +961,15 @@ class Unit(object):
     """
 
     command = self.eval(command)
-    if not shell:
-      command = shlex.split(command)
+    if shell:
+      args = _split_simple_command(command)
+      if args is not None:
+        try:
+          return creator.utils.ShellCall(args, cwd=cwd)
+        except OSError:
+          pass
+    else:
+      command = _shlex_split(command)
     return creator.utils.ShellCall(command, shell=shell, cwd=cwd)
 
   def target(self, name, inputs, outputs, command, requires=None,
@@ -618,7 +1004,21 @@ class Unit(object):
     target.command = command
     target.for_each = for_each
 
+    # Resolve the string requirements here so that the target dictionary
+    # of every referenced unit is only looked up once.
+    unit_targets = {}
     for item in requires:
+      if isinstance(item, str):
+        namespace, varname = creator.utils.parse_var(item)
+        namespace = namespace or self.identifier
+        targets = unit_targets.get(namespace)
+        if targets is None:
+          targets = self.workspace.get_unit(namespace).targets
+          unit_targets[namespace] = targets
+        if varname not in targets:
+          full_ident = creator.utils.create_var(namespace, varname)
+          raise ValueError('no such target', full_ident)
+        item = targets[varname]
       target.requires(item)
 
     self.targets[name] = target
@@ -649,17 +1049,19 @@ class Unit(object):
       requires = [requires]
 
     for item in requires:
-      if not isinstance(item, str) and not isinstance(item, BaseTarget):
+      if not isinstance(item, (str, BaseTarget)):
         raise TypeError('requirement must be str or BaseTarget', type(item))
 
     def decorator(func):
       if not callable(func):
         raise TypeError('func must be callable', type(func))
-      if func.__name__ in self.targets:
-        raise ValueError('task name already reserved', func.__name__)
-      task = Task(self, func.__name__, func, abstract=abstract)
-      [task.requires(req) for req in requires]
-      self.targets[func.__name__] = task
+      name = func.__name__
+      if name in self.targets:
+        raise ValueError('task name already reserved', name)
+      task = Task(self, name, func, abstract=abstract)
+      for item in requires:
+        task.requires(item)
+      self.targets[name] = task
       return func
 
     return decorator
@@ -686,6 +1088,9 @@ class BaseTarget(object):
       no data for this event.
   '''
 
+  __slots__ = ('unit', '_name', '_identifier', 'dependencies', 'listeners',
+    'is_setup', 'abstract')
+
   def __init__(self, unit, name, abstract=False):
     if not isinstance(unit, creator.unit.Unit):
       raise TypeError('unit must be creator.unit.Unit', type(unit))
@@ -694,24 +1099,21 @@ class BaseTarget(object):
     if not creator.utils.validate_identifier(name):
       raise ValueError('name is not a valid identifier', name)
     super().__init__()
-    self._unit = weakref.ref(unit)
+    self.unit = unit
     self._name = name
+    self._identifier = unit.identifier + ':' + name
     self.dependencies = []
     self.listeners = []
     self.is_setup = False
     self.abstract = abstract
 
-  @property
-  def unit(self):
-    return self._unit()
-
   @property
   def name(self):
     return self._name
 
   @property
   def identifier(self):
-    return self._unit().identifier + ':' + self._name
+    return self._identifier
 
   def acccept_requirement(self, target):
     """
@@ -735,12 +1137,13 @@ class BaseTarget(object):
       target (str or Target): The target to build before the current.
     """
 
+    unit = self.unit
     if isinstance(target, str):
-      target = self.unit.workspace.get_target(target, self.unit)
+      target = unit.workspace.get_target(target, unit)
     if target.abstract:
       if not self.abstract:
         raise ValueError('can not depend on abstract target')
-      if self.unit is not target.unit:
+      if unit is not target.unit:
         raise ValueError('can not depend on abstract target from different unit')
     self.acccept_requirement(target)
     if not target.is_setup:
@@ -781,8 +1184,9 @@ class BaseTarget(object):
     new *unit* instead of the *target*s old unit.
     '''
 
-    self._unit = weakref.ref(unit)
+    self.unit = unit
     self._name = target.name
+    self._identifier = unit.identifier + ':' + self._name
     self.dependencies = list(target.dependencies)
     self.listeners = list(target.listeners)
     self.is_setup = False
@@ -790,6 +1194,66 @@ class BaseTarget(object):
     unit.scope[self._name] = self
 
 
+def _split_command(node, context):
+  """
+  Private. Splits the parsed command *node* of a :class:`Target` into
+  the parts that expand the ``<`` and ``@`` macros and the parts that do
+  not depend on them, which are evaluated in *context*. Commands that
+  call a macro function other than the builtins are not split, as the
+  function could read the file macros from the context it is called in.
+
+  Returns:
+    tuple of (list, list of int, list of int): The parts with None in
+      place of the file macros and the indices of the ``<`` and ``@``
+      parts, or None if the file macros are used in any other way.
+  """
+
+  nodes = node.nodes if type(node) is creator.macro.ConcatNode else [node]
+  parts, in_slots, out_slots = [], [], []
+  for child in nodes:
+    if type(child) is creator.macro.VarNode and not child.args and \
+        child.varname in ('<', '@'):
+      slots = in_slots if child.varname == '<' else out_slots
+      slots.append(len(parts))
+      parts.append(None)
+    elif _uses_file_macros(child, context):
+      return None
+    else:
+      parts.append(child.eval(context, []))
+  return parts, in_slots, out_slots
+
+
+def _uses_file_macros(node, context):
+  """
+  Private. Returns True if the expression *node* may expand the ``<``
+  or ``@`` macro of a target command when it is evaluated in *context*.
+  """
+
+  node_type = type(node)
+  if node_type is creator.macro.TextNode:
+    return False
+  elif node_type is creator.macro.VarNode:
+    if node.varname in ('<', '@'):
+      return True
+    # Other macros are bound to their own context and can not see the
+    # file macros, but functions are called with *context*.
+    macro = context.get_macro(node.varname, None)
+    if isinstance(macro, creator.macro.Function) and \
+        _globals_dict.get(node.varname) is not macro:
+      return True
+    return any(_uses_file_macros(x, context) for x in node.args)
+  elif node_type is creator.macro.ConcatNode:
+    return any(_uses_file_macros(x, context) for x in node.nodes)
+  return True
+
+
+CommandData = collections.namedtuple('CommandData', 'inputs outputs command')
+CommandData.__doc__ = '''
+A command of a :class:`Target` with the lists of input and output files
+it is invoked for. Created when the target is set up.
+'''
+
+
 class Target(BaseTarget):
   """
   This class represents one or multiple build targets under one common
@@ -806,8 +1270,8 @@ class Target(BaseTarget):
     command (str)
     auxiliary (list of str): A list of additional files required as
       input files for building the target (eg. header files).
-    command_data (list of dicts, None): A dictionary that contains the final
-      data, evaluated when the target is setup.
+    command_data (list of CommandData, None): The final commands with
+      their input and output files, evaluated when the target is setup.
 
   Listener Events:
     - ``'build'``: Sent when :meth:`build` is called. The data for
@@ -818,6 +1282,9 @@ class Target(BaseTarget):
         dependencies.
   """
 
+  __slots__ = ('inputs', 'outputs', 'command', 'for_each', 'auxiliary',
+    'command_data')
+
   def __init__(self, unit, name, abstract=False):
     super().__init__(unit, name, abstract)
     self.inputs = None
@@ -843,36 +1310,70 @@ class Target(BaseTarget):
 
     super().do_setup()
     self.command_data = []
+    unit = self.unit
 
-    inputs = creator.utils.split(self.unit.eval(self.inputs))
-    inputs = [creator.utils.normpath(f) for f in inputs]
-
-    outputs = creator.utils.split(self.unit.eval(self.outputs))
-    outputs = [creator.utils.normpath(f) for f in outputs]
+    # The same files are usually referenced by several targets, eg. as
+    # output of one and input of another. Interning them stores every
+    # path once and lets set and dictionary lookups compare identities.
+    normpath, intern = creator.utils.normpath, sys.intern
+    inputs = creator.utils.split(unit.eval(self.inputs))
+    inputs = [intern(normpath(f)) for f in inputs]
 
-    context = creator.macro.MutableContext()
+    outputs = creator.utils.split(unit.eval(self.outputs))
+    outputs = [intern(normpath(f)) for f in outputs]
 
+    # Each command is built from the lists of its input and output files
+    # and the texts that the $< and $@ macros expand to.
     if self.for_each:
       if len(inputs) != len(outputs):
         raise ValueError('input file count must match output file count')
-      for fin, fout in zip(inputs, outputs):
-        context['<'] = raw(fin)
-        context['@'] = raw(fout)
-        command = self.unit.eval(self.command, context)
-        self.command_data.append({
-          'inputs': [fin],
-          'outputs': [fout],
-          'command': command,
-        })
+      pairs = [([fin], [fout], fin, fout) for fin, fout in zip(inputs, outputs)]
     else:
-      context['<'] = raw(creator.utils.join(inputs))
-      context['@'] = raw(creator.utils.join(outputs))
-      command = self.unit.eval(self.command, context)
-      self.command_data.append({
-        'inputs': inputs,
-        'outputs': outputs,
-        'command': command,
-      })
+      join = creator.utils.join
+      pairs = [(inputs, outputs, join(inputs), join(outputs))]
+
+    append = self.command_data.append
+    command = self.command
+    if '$' not in command and '\\' not in command:
+      # A command without macros or escapes does not depend on the
+      # input and output files, see Unit.eval().
+      command = command.strip()
+      for fin, fout, _, _ in pairs:
+        append(CommandData(fin, fout, command))
+      return
+
+    # The command is parsed only once and evaluated with the same
+    # context chain for every entry.
+    context = creator.macro.MutableContext()
+    chain = creator.macro.ChainContext(context, unit.context)
+    macro = creator.macro.parse(command, chain)
+
+    # Most commands only use $< and $@ directly. The rest of them is
+    # evaluated once and each command is joined from it.
+    parts = _split_command(macro, chain) if pairs else None
+    if parts is not None:
+      parts, in_slots, out_slots = parts
+      for fin, fout, in_text, out_text in pairs:
+        in_text, out_text = in_text.strip(), out_text.strip()
+        for index in in_slots:
+          parts[index] = in_text
+        for index in out_slots:
+          parts[index] = out_text
+        append(CommandData(fin, fout, ''.join(parts)))
+      return
+
+    # Only the texts of the $< and $@ macros change between the
+    # evaluations. They are plain text nodes that can not reference
+    # themselves, so they are stored in the macro dictionary directly.
+    # Nothing else can see them, so the same nodes are re-used.
+    in_node, out_node = raw(''), raw('')
+    context.macros['<'] = in_node
+    context.macros['@'] = out_node
+    evaluate = macro.eval
+    for fin, fout, in_text, out_text in pairs:
+      in_node.text = in_text
+      out_node.text = out_text
+      append(CommandData(fin, fout, evaluate(chain, [])))
 
   def build(self, *args, **kwargs):
     raise DeprecationWarning('Target.build() no longer supported')
@@ -889,38 +1390,47 @@ class Target(BaseTarget):
       RuntimeError: If the target or one of its dependencies is not set-up.
     """
 
+    identifier = self._identifier
     if not self.is_setup:
-      raise RuntimeError('target "{0}" not set-up'.format(self.identifier))
+      raise RuntimeError('target "{0}" not set-up'.format(identifier))
 
-    writer.comment('Target: {0}'.format(self.identifier))
+    writer.comment('Target: {0}'.format(identifier))
 
     # The outputs of depending targets must be listed additionally
     # to the actual input files of this target, otherwise ninja can
     # not know the targets depend on each other.
     infiles = set()
 
+    # The outputs are already normalized in do_setup().
     for dep in self.dependencies:
       if not dep.is_setup:
         raise RuntimeError('target "{0}" not set-up'.format(dep.identifier))
       for entry in dep.command_data:
-        infiles |= set(map(creator.utils.normpath, entry['outputs']))
+        infiles.update(entry.outputs)
 
-    infiles = list(infiles)
+    infiles = list(infiles) + self.auxiliary
     phonies = []
 
+    ninja_ident = creator.ninja.ident(identifier)
+    rule_format = ninja_ident + '_{0:04d}'
+    rule, build, newline = writer.rule, writer.build, writer.newline
+    # Entries with the same command share a rule, ninja identifies rules
+    # by their name only.
+    rule_names = {}
     for index, entry in enumerate(self.command_data):
-      rule_name = self.identifier + '_{0:04d}'.format(index)
-      rule_name = creator.ninja.ident(rule_name)
-      writer.rule(rule_name, entry['command'])
+      rule_name = rule_names.get(entry.command)
+      if rule_name is None:
+        rule_name = rule_names[entry.command] = rule_format.format(index)
+        rule(rule_name, entry.command)
 
-      assert len(entry['outputs']) != 0
-      inputs = list(entry['inputs']) + infiles + self.auxiliary
-      writer.build(entry['outputs'], rule_name, inputs)
+      outputs = entry.outputs
+      assert len(outputs) != 0
+      build(outputs, rule_name, entry.inputs + infiles)
 
-      writer.newline()
-      phonies.extend(entry['outputs'])
+      newline()
+      phonies.extend(outputs)
 
-    writer.build(creator.ninja.ident(self.identifier), 'phony', phonies)
+    build(ninja_ident, 'phony', phonies)
 
   def _copy_from(self, target, unit):
     super(Target, self)._copy_from(target, unit)
@@ -937,6 +1447,8 @@ class Task(BaseTarget):
   Represents a task-target that is run from Python.
   """
 
+  __slots__ = ('_func',)
+
   def __init__(self, unit, name, task_func, abstract=False):
     if not callable(task_func):
       raise TypeError('task_func must be callable', type(task_func))
@@ -949,7 +1461,28 @@ class Task(BaseTarget):
 
   def _copy_from(self, target, unit):
     super(Task, self)._copy_from(target, unit)
-    self._func = types.FunctionType(target._func.__code__, unit.scope)
+    func = target._func
+    if isinstance(func, types.FunctionType):
+      # Re-bind the function to the scope of the new unit but keep
+      # everything else the original function was defined with.
+      copy = types.FunctionType(func.__code__, unit.scope, func.__name__,
+        func.__defaults__, func.__closure__)
+      copy.__kwdefaults__ = func.__kwdefaults__
+      copy.__qualname__ = func.__qualname__
+      copy.__doc__ = func.__doc__
+      copy.__annotations__ = func.__annotations__
+      func = copy
+    self._func = func
+
+
+# The names of the macros that every unit context defines itself.
+_unit_presets = frozenset(['ProjectPath', 'self'])
+
+
+# The class dictionary of the global macro functions. Looking up names
+# in it directly avoids the exception handling of hasattr() and still
+# sees functions that are added to the class later.
+_globals_dict = vars(creator.macro.Globals)
 
 
 class WorkspaceContext(creator.macro.MutableContext):
@@ -958,35 +1491,95 @@ class WorkspaceContext(creator.macro.MutableContext):
   interface for the global macro context of a :class:`Workspace`.
   """
 
+  __slots__ = ('workspace', '_namespaces', '_lazy_macros', '_environ_nodes')
+
   def __init__(self, workspace):
     super().__init__()
-    self._workspace = weakref.ref(workspace)
-    self['Platform'] = creator.macro.TextNode(creator.platform.platform_name)
-    self['PlatformStandard'] = creator.macro.TextNode(
-      creator.platform.platform_standard)
-    self['Architecture'] = creator.macro.TextNode(
-      creator.platform.architecture)
+    self.workspace = workspace
+    # Maps namespaces to dictionaries of the macros in that namespace,
+    # keyed by the name without the namespace prefix.
+    self._namespaces = {}
+    # The platform macros are only created when they are accessed.
+    self._lazy_macros = set(self._platform_macros)
+    # TextNodes for environment variables, see get_macro().
+    self._environ_nodes = {}
+
+  # Maps the names of the platform macros to the name of the
+  # attribute in the :mod:`creator.platform` module.
+  _platform_macros = {
+    'Platform': 'platform_name',
+    'PlatformStandard': 'platform_standard',
+    'Architecture': 'architecture',
+  }
+
+  def _create_lazy_macro(self, name):
+    """
+    Private. Creates the platform macro *name* if it was not created
+    or overwritten yet.
+    """
 
-  @property
-  def workspace(self):
-    return self._workspace()
+    if name in self._lazy_macros:
+      self._lazy_macros.discard(name)
+      value = getattr(creator.platform, self._platform_macros[name])
+      self.macros[name] = creator.macro.TextNode(value)
+
+  def __setitem__(self, name, value):
+    # The new value may reference the previous value.
+    self._create_lazy_macro(name)
+    super().__setitem__(name, value)
+    namespace, sep, varname = name.partition(':')
+    if sep:
+      self._namespaces.setdefault(namespace, {})[varname] = self.macros[name]
+
+  def __delitem__(self, name):
+    self._lazy_macros.discard(name)
+    super().__delitem__(name)
+    namespace, sep, varname = name.partition(':')
+    if sep:
+      self._namespaces.get(namespace, {}).pop(varname, None)
+
+  def namespace_items(self, namespace):
+    """
+    Returns:
+      An iterable of ``(varname, macro)`` pairs of all macros in the
+      specified *namespace*, without the namespace prefix.
+    """
+
+    if ':' in namespace:
+      prefix = namespace + ':'
+      return ((key[len(prefix):], value) for key, value in self.macros.items()
+              if key.startswith(prefix))
+    return self._namespaces.get(namespace, {}).items()
 
   def has_macro(self, name):
-    try:
-      self.get_macro(name)
-    except KeyError:
-      return False
-    return True
+    if name in self.macros or name in self._lazy_macros:
+      return True
+    if isinstance(_globals_dict.get(name), creator.macro.Function):
+      return True
+    return name in os.environ
 
   def get_macro(self, name, default=NotImplemented):
-    macro = super().get_macro(name, None)
+    # Look through the macros, the platform macros that have not been
+    # created yet, the global functions and the environment in order.
+    macro = self.macros.get(name)
     if macro is not None:
       return macro
-    if not name.startswith('_') and hasattr(creator.macro.Globals, name):
-      return getattr(creator.macro.Globals, name)
-    if name in os.environ:
-      return creator.macro.TextNode(os.environ[name])
-    raise KeyError(name)
+    if name in self._lazy_macros:
+      self._create_lazy_macro(name)
+      return self.macros[name]
+    macro = _globals_dict.get(name)
+    if isinstance(macro, creator.macro.Function):
+      return macro
+    value = os.environ.get(name)
+    if value is not None:
+      # Re-use the node as long as the variable has the same value.
+      node = self._environ_nodes.get(name)
+      if node is None or node.text != value:
+        node = self._environ_nodes[name] = creator.macro.TextNode(value)
+      return node
+    if default is NotImplemented:
+      raise KeyError(name)
+    return default
 
   def get_namespace(self):
     return ''
@@ -998,46 +1591,74 @@ class UnitContext(creator.macro.ContextProvider):
   interface for the local macro context of a :class:`Unit`.
   """
 
+  __slots__ = ('unit', 'workspace', '_identifier', '_prepared_names',
+    '_macros_get')
+
   def __init__(self, unit):
     super().__init__()
-    self._unit = weakref.ref(unit)
-    self['self'] = creator.macro.TextNode(self.unit.identifier)
-    self['ProjectPath'] = creator.macro.TextNode(unit.project_path)
-
-  @property
-  def unit(self):
-    return self._unit()
-
-  @property
-  def workspace(self):
-    return self._unit().workspace
+    self.unit = unit
+    self.workspace = unit.workspace
+    self._identifier = unit.identifier
+    self._prepared_names = {}
+    # The workspace macro dictionary is never replaced, its lookup
+    # method can be bound once for get_macro().
+    context = self.workspace.context
+    self._macros_get = context.macros.get
+    # The names of the preset macros are known, so they are assigned
+    # to the workspace context without preparing them first.
+    prefix = self._identifier + ':'
+    context[prefix + 'self'] = creator.macro.TextNode(self._identifier)
+    context[prefix + 'ProjectPath'] = creator.macro.TextNode(unit.project_path)
 
   def _prepare_name(self, name):
-    namespace, varname = creator.utils.parse_var(name)
-    if namespace in self.unit.aliases:
-      namespace = self.unit.aliases[namespace]
+    # The result only depends on the alias of the namespace in *name*,
+    # so a cached result is valid as long as that alias is unchanged.
+    # The aliases dictionary can be modified at any time by the unit.
+    aliases = self.unit.aliases
+    cached = self._prepared_names.get(name)
+    if cached is not None and \
+        aliases.get(cached[1], NotImplemented) is cached[2]:
+      return cached[0]
+
+    # Same as creator.utils.parse_var() and create_var(), inlined.
+    namespace, sep, varname = name.partition(':')
+    if not varname:
+      namespace, varname = varname, namespace
+    if not sep:
+      namespace = None
+    # A single lookup serves both the membership test and the value.
+    alias = aliases.get(namespace, NotImplemented)
+    if alias is not NotImplemented:
+      result = varname if alias is None else alias + ':' + varname
     elif namespace is None:
-      namespace = self.unit.identifier
+      result = self._identifier + ':' + varname
     elif not namespace:
       # Empty namespace specified, the resulting variable
       # should have no namespace identifier in it.
-      namespace = None
-    return creator.utils.create_var(namespace, varname)
+      result = varname
+    else:
+      result = name
+    self._prepared_names[name] = (result, namespace, alias)
+    return result
 
   def __setitem__(self, name, value):
     if isinstance(value, str):
-      value = creator.macro.parse(value, self)
-    if not isinstance(value, creator.macro.ExpressionNode):
+      # Many macros are never evaluated, parse them on demand.
+      value = creator.macro.LazyNode(value, self)
+    elif not creator.macro.is_node(value):
       raise TypeError('value must be str or ExpressionNode', type(value))
     name = self._prepare_name(name)
     self.workspace.context[name] = value
 
   def items(self):
-    namespace = creator.utils.create_var(self.unit.identifier, '')
-    for key, value in self.workspace.context.macros.items():
-      if key.startswith(namespace):
-        key = key[len(namespace):]
-        yield (key, value)
+    """
+    Returns:
+      list of (str, ExpressionNode): The macros of this unit without
+        the namespace prefix. The list is a snapshot, so the context
+        may be modified while iterating over it.
+    """
+
+    return list(self.workspace.context.namespace_items(self._identifier))
 
   def transition(self, key, value):
     '''
@@ -1046,24 +1667,32 @@ class UnitContext(creator.macro.ContextProvider):
     to this unit context.
     '''
 
-    if isinstance(value, creator.macro.ExpressionNode):
+    # Plain text does not depend on a context and is never modified
+    # in place, so it can be shared.
+    if type(value) is not creator.macro.TextNode and \
+        creator.macro.is_node(value):
       value = value.copy(self)
     self[key] = value
 
   def has_macro(self, name):
-    if self.workspace.context.has_macro(self._prepare_name(name)):
-      return True
-    return self.workspace.context.has_macro(name)
+    return self.get_macro(name, None) is not None
 
   def get_macro(self, name, default=NotImplemented):
-    try:
-      return self.workspace.context.get_macro(self._prepare_name(name))
-    except KeyError:
-      try:
-        return self.workspace.context.get_macro(name)
-      except KeyError:
-        pass
-    raise KeyError(name)
+    prepared = self._prepare_name(name)
+    macro = self._macros_get(prepared)
+    if macro is None:
+      context = self.workspace.context
+      # Names with a namespace can only be found in the macro dictionary,
+      # the fallbacks of the workspace context only apply to plain names.
+      if ':' not in prepared:
+        macro = context.get_macro(prepared, None)
+      if macro is None:
+        macro = context.get_macro(name, None)
+    if macro is not None:
+      return macro
+    if default is NotImplemented:
+      raise KeyError(name)
+    return default
 
   def get_namespace(self):
-    return self.unit.identifier
+    return self._identifier
@@ -19,6 +19,7 @@
 # THE SOFTWARE.
 
 import collections
+import functools
 import io
 import os
 import re
@@ -64,16 +65,27 @@ def join(items):
 
 
 def normpath(x):
+  # Relative paths depend on the current working directory and can
+  # not be cached by their string alone.
+  if os.path.isabs(x):
+    return _normpath_abs(x)
   return os.path.normpath(os.path.abspath(os.path.expanduser(x)))
 
 
+@functools.lru_cache(maxsize=4096)
+def _normpath_abs(x):
+  return os.path.normpath(x)
+
+
+@functools.lru_cache(maxsize=2048)
 def parse_var(var):
   """
   Parses a variable name with an optional namespace access and
   returns a tuple of ``(namespace, varname)``. If a namespace
   separator is specified, the returned namespace will be an
   empty string (as there should be a namespace but there were
-  no characters for it).
+  no characters for it). The results are cached as the same names
+  are resolved over and over again.
   """
 
   namespace, sep, varname = var.partition(':')
@@ -108,19 +120,22 @@ def read_metadata(filename):
       @key = value
   """
 
-  regex = re.compile('^#\s*@([\w\.\_\-]+)\s*=\s*(.*)')
   metadata = {}
+  match_line = _metadata_regex.match
   with open(filename) as fp:
     for line in fp:
       if not line.startswith('#'):
         break
-      match = regex.match(line)
+      match = match_line(line)
       if not match:
         continue
       metadata[match.group(1)] = match.group(2)
   return metadata
 
 
+_metadata_regex = re.compile('^#\s*@([\w\.\_\-]+)\s*=\s*(.*)')
+
+
 def set_suffix(filename, suffix):
   """
   Changes the suffix of the specified *filename* to *suffix*. If the
@@ -156,6 +171,10 @@ def split(text):
     list of str: The resulting list.
   """
 
+  # Without backslashes there can be no escaped semicolons.
+  if text and '\\' not in text:
+    return [item for item in text.split(';') if item]
+
   items = []
   while text:
     index = text.find(';')
@@ -244,7 +263,10 @@ def validate_identifier(identifier):
       False if it is not.
   """
 
-  return bool(re.match('^[A-Za-z0-9\-\._]+$', identifier))
+  return bool(_identifier_regex.match(identifier))
+
+
+_identifier_regex = re.compile('^[A-Za-z0-9\-\._]+$')
 
 
 Cursor = collections.namedtuple('Cursor', 'position lineno colno')
@@ -22,20 +22,17 @@
 import os
 import sys
 
-if hasattr(os.path, 'samefile'):
-  samefile = os.path.samefile
-else:
-  def samefile(fn1, fn2):
-    if os.path.isfile(fn1) and os.path.isfile(fn2):
-      return os.stat(fn1) == os.stat(fn2)
-    else:
-      return False
-
 # Remove all paths that contain exactly this file. It would import itself
-# instead of the creator module.
+# instead of the creator module. Files are compared by device and inode,
+# which needs only a single stat call per path entry.
+_self_stat = os.stat(__file__)
+_self_key = (_self_stat.st_dev, _self_stat.st_ino)
 for path in sys.path[:]:
-  ref_file = os.path.join(path, 'creator.py')
-  if os.path.isfile(ref_file):
+  try:
+    st = os.stat(os.path.join(path, 'creator.py'))
+  except OSError:
+    continue
+  if (st.st_dev, st.st_ino) == _self_key:
     sys.path.remove(path)
 
 import creator.__main__
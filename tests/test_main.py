@@ -0,0 +1,147 @@
+# Copyright (C) 2015 Niklas Rosenstein
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"), to deal
+# in the Software without restriction, including without limitation the rights
+# to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
+# copies of the Software, and to permit persons to whom the Software is
+# furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included in
+# all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+import unittest.mock
+
+from creator.__main__ import complete_target_list, export_build_file
+
+
+class _Node(object):
+  """
+  Stands in for a :class:`creator.unit.Target` or :class:`creator.unit.Task`,
+  :func:`complete_target_list` only reads the dependencies.
+  """
+
+  def __init__(self, name, *dependencies):
+    self.name = name
+    self.dependencies = list(dependencies)
+
+  def __repr__(self):
+    return self.name
+
+
+def _names(targets):
+  return [target.name for target in targets]
+
+
+class CompleteTargetListTest(unittest.TestCase):
+
+  def test_keeps_command_line_order(self):
+    # A mixed list of targets and tasks, 'clean' must not be moved
+    # behind the target that is specified after it.
+    a = _Node('a')
+    b = _Node('b')
+    c = _Node('c', a)
+    clean = _Node('clean')
+    targets = [c, clean, b]
+    complete_target_list(targets)
+    self.assertEqual(_names(targets), ['a', 'c', 'clean', 'b'])
+
+  def test_dependencies_before_their_root(self):
+    lib = _Node('lib')
+    objs = _Node('objs', lib)
+    hello = _Node('hello', objs)
+    lit = _Node('lit', lib, _Node('gen'))
+    targets = [hello, lit]
+    complete_target_list(targets)
+    self.assertEqual(_names(targets), ['lib', 'objs', 'hello', 'gen', 'lit'])
+
+  def test_shared_dependencies_are_listed_once(self):
+    a = _Node('a')
+    b = _Node('b', a)
+    c = _Node('c', a, b)
+    targets = [c, b, a]
+    complete_target_list(targets)
+    self.assertEqual(_names(targets), ['a', 'b', 'c'])
+
+  def test_cycle(self):
+    a = _Node('a')
+    b = _Node('b', a)
+    a.dependencies.append(b)
+    with self.assertRaises(RuntimeError):
+      complete_target_list([a])
+
+
+def _export(fp, workspace, unit, targets):
+  fp.write('build all: phony\n')
+
+
+@unittest.mock.patch('creator.ninja.export', _export)
+class ExportBuildFileTest(unittest.TestCase):
+
+  def setUp(self):
+    self.dirname = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.dirname)
+
+  def path(self, name):
+    return os.path.join(self.dirname, name)
+
+  def read(self, name):
+    with open(self.path(name)) as fp:
+      return fp.read()
+
+  def test_regular_file_keeps_its_mode(self):
+    filename = self.path('build.ninja')
+    with open(filename, 'w') as fp:
+      fp.write('old')
+    os.chmod(filename, 0o640)
+    export_build_file(filename, None, None, [])
+    self.assertEqual(self.read('build.ninja'), 'build all: phony\n')
+    self.assertEqual(stat.S_IMODE(os.stat(filename).st_mode), 0o640)
+    self.assertEqual(os.listdir(self.dirname), ['build.ninja'])
+
+  @unittest.skipUnless(hasattr(os, 'symlink'), 'requires symlinks')
+  def test_symlink_is_written_through(self):
+    with open(self.path('real.ninja'), 'w') as fp:
+      fp.write('old')
+    os.symlink('real.ninja', self.path('build.ninja'))
+    export_build_file(self.path('build.ninja'), None, None, [])
+    self.assertTrue(os.path.islink(self.path('build.ninja')))
+    self.assertEqual(self.read('real.ninja'), 'build all: phony\n')
+    self.assertEqual(sorted(os.listdir(self.dirname)),
+      ['build.ninja', 'real.ninja'])
+
+  @unittest.skipUnless(hasattr(os, 'mkfifo'), 'requires named pipes')
+  def test_fifo_is_written_to(self):
+    filename = self.path('build.ninja')
+    os.mkfifo(filename)
+    result = []
+    def reader():
+      with open(filename) as fp:
+        result.append(fp.read())
+    thread = threading.Thread(target=reader)
+    thread.start()
+    export_build_file(filename, None, None, [])
+    thread.join()
+    self.assertEqual(result, ['build all: phony\n'])
+    self.assertTrue(stat.S_ISFIFO(os.lstat(filename).st_mode))
+    self.assertEqual(os.listdir(self.dirname), ['build.ninja'])
+
+
+if __name__ == '__main__':
+  unittest.main()